@@ -19,21 +19,32 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from adapt.intent import IntentBuilder
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from mycroft.skills.core import MycroftSkill
 from mycroft.util.log import getLogger
+from os import remove
 from os.path import dirname
+from os.path import join
 from phue import Bridge
 from phue import Group
 from phue import PhueRegistrationException
 from phue import PhueRequestTimeout
+from time import monotonic
 from time import sleep
+from threading import Event
+from threading import Lock
+from threading import Thread
+from threading import Timer
+from threading import current_thread
 from requests import ConnectionError
-from requests import get
-import upnpclient
-import urllib
-from fuzzywuzzy import process
-from rgbxy import Converter, get_light_gamut
-
+from requests import RequestException
+from requests import Session
+from requests import Timeout
+from requests.adapters import HTTPAdapter
+
+import json
+import re
+import select
 import socket
 
 __author__ = 'ChristopherRogers1991'
@@ -44,6 +55,44 @@ LOGGER = getLogger(__name__)
 DEFAULT_BRIGHTNESS_STEP = 50
 DEFAULT_COLOR_TEMPERATURE_STEP = 1000
 
+# (hue, saturation) for each name in vocab/*/color.entity
+COLORS = {
+    "red":    (65160, 254),
+    "green":  (27975, 254),
+    "blue":   (45908, 254),
+    "pink":   (52673, 254),
+    "violet": (48156, 254),
+    "yellow": (10821, 254),
+    "orange": ( 6308, 254),
+    "white":  (41439,  81),
+}
+
+FUZZY_CACHE_SIZE = 256  # cached group/scene lookups before starting over
+_MISS = object()  # _fuzzy_cache sentinel; None is a cached "no match"
+STATE_FLUSH_DELAY = 0.15  # seconds to coalesce state writes per group
+KEEPALIVE_INTERVAL = 25  # seconds between idle requests to the bridge
+REGISTRATION_TIMEOUT = 30  # seconds to wait for the link button
+
+N_UPNP_URL = 'https://discovery.meethue.com/'
+
+SSDP_ADDR = "239.255.255.250"
+SSDP_PORT = 1900
+SSDP_MX = 1
+SSDP_ST = "urn:schemas-upnp-org:device:Basic:1"
+SSDP_TIMEOUT = 2.0  # seconds to wait for replies
+SSDP_RESEND_DELAY = 0.3
+
+SSDP_REQUEST = ("M-SEARCH * HTTP/1.1\r\n" +
+                "HOST: %s:%d\r\n" % (SSDP_ADDR, SSDP_PORT) +
+                "MAN: \"ssdp:discover\"\r\n" +
+                "MX: %d\r\n" % (SSDP_MX,) +
+                "ST: %s\r\n" % (SSDP_ST,) + "\r\n").encode()
+
+# Host of the LOCATION header in a reply that also carries hue-bridgeid
+SSDP_BRIDGE_RE = re.compile(rb'LOCATION:\s*http://([^/\s:]+)[^\r\n]*\r\n'
+                            rb'(?:[^\r\n]+\r\n)*?hue-bridgeid',
+                            re.IGNORECASE)
+
 
 class DeviceNotFoundException(Exception):
     pass
@@ -56,6 +105,29 @@ class UnauthorizedUserException(Exception):
         super(UnauthorizedUserException, self).__init__(msg.format(username))
 
 
+class SessionBridge(Bridge):
+    """
+    A phue Bridge that sends its requests through a shared
+    requests.Session, so connections to the bridge are reused
+    rather than opened for every call.
+    """
+
+    def __init__(self, session, ip=None, username=None):
+        self.session = session
+        super(SessionBridge, self).__init__(ip, username)
+
+    def request(self, mode='GET', address=None, data=None):
+        url = 'http://{ip}{address}'.format(ip=self.ip, address=address)
+        body = json.dumps(data) if data is not None else None
+        try:
+            response = self.session.request(mode, url, data=body, timeout=10)
+        except Timeout:
+            error = "{0} Request to {1}{2} timed out.".format(mode, self.ip,
+                                                             address)
+            raise PhueRequestTimeout(None, error)
+        return response.json()
+
+
 def intent_handler(handler_function):
     """
     Decorate handler functions with connection and
@@ -110,7 +182,8 @@ def get_group(f):
         if group is None:
             self.speak_dialog('could.not.find.group', {'name': group_name})
         else:
-            f(self, message, group)
+            future = self._io.submit(f, self, message, group)
+            future.add_done_callback(self._on_intent_done)
     return inner
 
 
@@ -129,27 +202,34 @@ class PhillipsHueSkill(MycroftSkill):
             verbose = verbose.lower()
             verbose = True if verbose == 'true' else False
         self.verbose = verbose
-        converter = Converter()
-        self.colors = {
-                "red":    (65160, 254),
-                "green":  (27975, 254),
-                "blue":   (45908, 254),
-                "pink":   (52673, 254),
-                "violet": (48156, 254),
-                "yellow": (10821, 254),
-                "orange": ( 6308, 254),
-                "white":  (41439,  81),
-                }
 
         self.username = self.settings.get('username')
         if self.username == '':
             self.username = None
 
-        self.ip = None  # set in _connect_to_bridge
+        self._session = Session()
+        self._session.mount('http://', HTTPAdapter(pool_connections=1,
+                                                   pool_maxsize=8,
+                                                   max_retries=0))
+        self._session.headers['Connection'] = 'keep-alive'
+        self._keepalive_thread = None
+        self._stopping = Event()
+
+        # A single worker keeps bridge writes in the order they were given
+        self._io = ThreadPoolExecutor(max_workers=1,
+                                      thread_name_prefix='hue-io')
+
+        self._pending = dict()  # group id -> state awaiting a flush
+        self._pending_lock = Lock()
+        self._flush_timer = None
+
+        self.ip = None  # set in _connect_to_bridge, or from the cache
         self.bridge = None
         self.default_group = None
         self.groups_to_ids_map = dict()
         self.scenes_to_ids_map = defaultdict(dict)
+        self._fuzzy_cache = dict()
+        self._vocab_gen = 0  # bumped whenever the maps above change
 
     @property
     def connected(self):
@@ -170,13 +250,14 @@ class PhillipsHueSkill(MycroftSkill):
         to use, this will cause one to be generated.
         """
         self.speak_dialog('connect.to.bridge')
-        i = 0
-        while i < 30:
-            sleep(1)
+        deadline = monotonic() + REGISTRATION_TIMEOUT
+        delay = 0.25
+        while monotonic() < deadline:
             try:
-                self.bridge = Bridge(self.ip)
+                self.bridge = SessionBridge(self._session, self.ip)
             except PhueRegistrationException:
-                continue
+                sleep(delay)
+                delay = min(delay * 1.5, 2.0)
             else:
                 break
         if not self.connected:
@@ -196,11 +277,66 @@ class PhillipsHueSkill(MycroftSkill):
         with self.file_system.open('username', 'w') as conf_file:
             conf_file.write(self.username)
 
+        if not self.user_supplied_ip:
+            with self.file_system.open('bridge_ip', 'w') as conf_file:
+                conf_file.write(self.ip)
+
         if not self.default_group:
             self._set_default_group(self.settings.get('default_group'))
 
         self._register_groups_and_scenes()
 
+        if self._keepalive_thread is None \
+                or not self._keepalive_thread.is_alive():
+            self._keepalive_thread = Thread(target=self._keepalive_loop,
+                                            name='hue-keepalive',
+                                            daemon=True)
+            self._keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        """
+        Periodically touch the bridge so it does not close the
+        pooled connection between voice commands.
+        """
+        while not self._stopping.wait(KEEPALIVE_INTERVAL) and self.connected:
+            url = 'http://{ip}/api/{user}/config'.format(ip=self.ip,
+                                                         user=self.username)
+            try:
+                self._session.get(url, timeout=2)
+            except RequestException:
+                pass
+
+    def _forget_bridge_ip(self):
+        """
+        Drop the cached bridge ip, so the next connection
+        attempt goes through discovery.
+        """
+        self.ip = None
+        if self.file_system.exists('bridge_ip'):
+            remove(join(self.file_system.path, 'bridge_ip'))
+
+    def _fast_discover(self):
+        """
+        Find the bridge using the Hue N-UPnP endpoint, falling
+        back to an SSDP search of the local network.
+
+        Raises
+        ------
+        DeviceNotFoundException
+            If the bridge is not found.
+
+        Returns
+        -------
+        str
+            An IP address representing the bridge that was found
+        """
+        try:
+            bridges = self._session.get(N_UPNP_URL, timeout=2).json()
+            return bridges[0]['internalipaddress']
+        except (RequestException, ValueError, LookupError, TypeError):
+            LOGGER.debug("N-UPnP discovery failed, falling back to SSDP")
+        return _discover_bridge()
+
     def _attempt_connection(self):
         """
         This will attempt to connect to the bridge,
@@ -213,13 +349,53 @@ class PhillipsHueSkill(MycroftSkill):
         """
         if self.user_supplied_ip:
             self.ip = self.settings.get('ip')
-        else:
-            device = next(filter(lambda device : "Philips hue" in device.model_name, upnpclient.discover()))
-            self.ip = urllib.parse.urlparse(device.location).hostname
+        elif self.ip is not None:
+            try:
+                self._verify_bridge_ip()
+                self._connect_to_ip()
+                return
+            except (UnauthorizedUserException, PhueRegistrationException):
+                # The bridge is there; it is the user that needs sorting out
+                raise
+            except Exception:
+                # Anything else means the cached ip no longer points
+                # at our bridge (e.g. a stale DHCP lease)
+                LOGGER.info("No bridge found at cached ip {0}; "
+                            "rediscovering".format(self.ip))
+                self._forget_bridge_ip()
+        if not self.user_supplied_ip:
+            self.ip = self._fast_discover()
+        self._connect_to_ip()
+
+    def _verify_bridge_ip(self):
+        """
+        Check that a Hue bridge answers at self.ip, using the
+        config endpoint, which does not need a username.
+
+        Raises
+        ------
+        DeviceNotFoundException
+            If the reply is not a Hue bridge config.
+        """
+        url = 'http://{ip}/api/config'.format(ip=self.ip)
+        data = self._session.get(url, timeout=3).json()
+        if not isinstance(data, dict) or 'bridgeid' not in data:
+            raise DeviceNotFoundException()
+
+    def _connect_to_ip(self):
+        """
+        Connect to the bridge at self.ip, verifying
+        self.username if we have one.
+
+        Raises
+        ------
+        UnauthorizedUserException
+            If self.username is not None, and is not registered with the bridge
+        """
         if self.username:
             url = 'http://{ip}/api/{user}'.format(ip=self.ip,
                                                   user=self.username)
-            data = get(url).json()
+            data = self._session.get(url, timeout=3).json()
             data = data[0] if isinstance(data, list) else data
             error = data.get('error')
             if error:
@@ -229,7 +405,7 @@ class PhillipsHueSkill(MycroftSkill):
                 else:
                     raise Exception('Unknown Error: {0}'.format(description))
 
-        self.bridge = Bridge(self.ip, self.username)
+        self.bridge = SessionBridge(self._session, self.ip, self.username)
 
     def _connect_to_bridge(self, acknowledge_successful_connection=False):
         """
@@ -312,18 +488,39 @@ class PhillipsHueSkill(MycroftSkill):
         and update our caches.
         """
         groups = self.bridge.get_group()
-        for id, group in groups.items():
-            name = group['name'].lower()
-            self.groups_to_ids_map[name] = id
-            self.register_vocabulary(name, "Group")
+        self.groups_to_ids_map = {group['name'].lower(): id
+                                  for id, group in groups.items()}
+        self._register_unique_vocabulary(self.groups_to_ids_map, "Group")
 
         scenes = self.bridge.get_scene()
+        scenes_to_ids_map = defaultdict(dict)
+        scene_names = set()
         for id, scene in scenes.items():
             name = scene['name'].lower()
             group_id = scene.get('group')
             group_id = int(group_id) if group_id else None
-            self.scenes_to_ids_map[group_id][name] = id
-            self.register_vocabulary(name, "Scene")
+            scenes_to_ids_map[group_id][name] = id
+            scene_names.add(name)
+        self.scenes_to_ids_map = scenes_to_ids_map
+        self._register_unique_vocabulary(scene_names, "Scene")
+
+        self._vocab_gen += 1
+        self._fuzzy_cache.clear()
+
+    def _register_unique_vocabulary(self, names, entity_type):
+        """
+        Register each distinct name once as vocab of the given type.
+
+        Scenes commonly share names across groups (e.g. "bright"),
+        so de-duplicating avoids a bus message per repeat.
+
+        Parameters
+        ----------
+        names : iterable of str
+        entity_type : str
+        """
+        for name in sorted(set(names)):
+            self.register_vocabulary(name, entity_type)
 
     def initialize(self):
         """
@@ -332,6 +529,10 @@ class PhillipsHueSkill(MycroftSkill):
         """
         self.load_data_files(dirname(__file__))
 
+        if self.file_system.exists('bridge_ip'):
+            with self.file_system.open('bridge_ip', 'r') as conf_file:
+                self.ip = conf_file.read().strip(' \n') or None
+
         if self.file_system.exists('username'):
             if not self.user_supplied_username:
                 with self.file_system.open('username', 'r') as conf_file:
@@ -379,14 +580,106 @@ class PhillipsHueSkill(MycroftSkill):
         #                      self.handle_connect_lights_intent)
 
     def _find_fuzzy(self, dictionary, value):
-        result = process.extractOne(value, dictionary.keys())
-        if result is None:
-            return None
-        (value, confidence) = result
-        if confidence < 60:
-            return None
+        value = value.lower()
+        key = (id(dictionary), self._vocab_gen, value)
+        # A single get, as the cache may be cleared from another thread
+        match = self._fuzzy_cache.get(key, _MISS)
+        if match is not _MISS:
+            return match
+        from rapidfuzz import fuzz, process, utils  # only needed on a miss
+        result = process.extractOne(value, dictionary.keys(),
+                                    scorer=fuzz.WRatio,
+                                    processor=utils.default_process,
+                                    score_cutoff=60)
+        match = None if result is None else dictionary[result[0]]
+        if len(self._fuzzy_cache) >= FUZZY_CACHE_SIZE:
+            self._fuzzy_cache.clear()
+        self._fuzzy_cache[key] = match
+        return match
+
+    def _on_intent_done(self, future):
+        """
+        Report errors raised by a handler that ran on the
+        bridge I/O pool.
+
+        Parameters
+        ----------
+        future : concurrent.futures.Future
+        """
+        error = future.exception()
+        if error is None:
+            return
+        if isinstance(error, PhueRequestTimeout):
+            self.speak_dialog('unable.to.perform.action')
+        elif isinstance(error, (ConnectionError, socket.error)):
+            self.speak_dialog('could.not.communicate')
         else:
-            return dictionary[value]
+            LOGGER.error("Hue intent failed", exc_info=error)
+
+    def _queue_group_state(self, group_id, state):
+        """
+        Merge state into the pending write for a group, and
+        (re)schedule the flush, so bursts of adjustments reach
+        the bridge as a single request per group.
+
+        Parameters
+        ----------
+        group_id : int
+        state : dict
+            Group action parameters, e.g. {'on': True, 'bri': 127}
+        """
+        with self._pending_lock:
+            pending = self._pending.setdefault(group_id, {})
+            if state.get('on') is False:
+                # Nothing else can be set on lights that are off
+                pending.clear()
+            pending.update(state)
+            self._schedule_flush(STATE_FLUSH_DELAY)
+
+    def _schedule_flush(self, delay):
+        """
+        Restart the flush timer. Must hold self._pending_lock.
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+        self._flush_timer = Timer(delay, self._submit_flush)
+        self._flush_timer.daemon = True
+        self._flush_timer.start()
+
+    def _submit_flush(self):
+        """
+        Timer callback: queue a flush on the bridge I/O pool,
+        unless the skill is shutting down.
+        """
+        with self._pending_lock:
+            if self._flush_timer is current_thread():
+                self._flush_timer = None
+            if self._stopping.is_set():
+                return
+            future = self._io.submit(self._flush_pending)
+        future.add_done_callback(self._on_intent_done)
+
+    def _flush_pending(self):
+        """
+        Send all pending group state. Handlers that write to the
+        bridge directly call this first, so their write cannot be
+        overtaken by an older queued one. Groups can share lights,
+        so every group is flushed, not just the one being written.
+        """
+        error = None
+        while True:
+            with self._pending_lock:
+                if not self._pending:
+                    break
+                group_id = next(iter(self._pending))
+                state = self._pending.pop(group_id)
+            try:
+                self.bridge.set_group(group_id, state)
+            except Exception as e:
+                # Keep sending the other groups; report the first failure
+                error = error or e
+        if error is not None:
+            raise error
 
     def _find_group(self, group_name):
         group_id = self._find_fuzzy(self.groups_to_ids_map, group_name)
@@ -395,10 +688,12 @@ class PhillipsHueSkill(MycroftSkill):
 
     @get_group
     def handle_turn_on_intent(self, message, group):
+        self._flush_pending()
         group.on = True
 
     @get_group
     def handle_turn_off_intent(self, message, group):
+        self._flush_pending()
         group.on = False
 
     @get_group
@@ -406,11 +701,11 @@ class PhillipsHueSkill(MycroftSkill):
         value = message.data.get('percent')
         value = int(value.rstrip('%'))
         if value == 0:
-            group.on = False
+            state = {'on': False}
         else:
             brightness = int(value / 100.0 * 254)
-            group.on = True
-            group.brightness = brightness
+            state = {'on': True, 'bri': brightness}
+        self._queue_group_state(group.group_id, state)
         if self.verbose:
             self.speak_dialog('set.brightness', {'brightness': value})
 
@@ -425,6 +720,7 @@ class PhillipsHueSkill(MycroftSkill):
             if self.verbose:
                 self.speak_dialog('activate.scene',
                                   {'scene': scene_name})
+            self._flush_pending()
             self.bridge.activate_scene(group.group_id, scene_id)
         else:
             self.speak_dialog('scene.not.found',
@@ -432,12 +728,11 @@ class PhillipsHueSkill(MycroftSkill):
 
     @get_group
     def handle_set_lights_color_intent(self, message, group):
+        self._flush_pending()
         color_name = message.data.get('color')
-        (hue, sat) = self.colors[color_name]
-        for light in group.lights:
-            light.on = True
-            light.hue = hue
-            light.saturation = sat
+        (hue, sat) = COLORS[color_name]
+        self.bridge.set_group(group.group_id,
+                              {'on': True, 'hue': hue, 'sat': sat})
 
     # TODO support
     # @intent_handler
@@ -486,6 +781,19 @@ class PhillipsHueSkill(MycroftSkill):
     def stop(self):
         pass
 
+    def shutdown(self):
+        self._stopping.set()
+        with self._pending_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+            if self._pending:
+                # Send changes made within the last flush delay; the
+                # pool still runs queued work after shutdown(wait=False)
+                self._io.submit(self._flush_pending).add_done_callback(
+                    self._on_intent_done)
+        self._io.shutdown(wait=False)
+        super(PhillipsHueSkill, self).shutdown()
+
 
 def _discover_bridge():
     """
@@ -502,30 +810,34 @@ def _discover_bridge():
     str
         An IP address representing the bridge that was found
     """
-    SSDP_ADDR = "239.255.255.250"
-    SSDP_PORT = 1900
-    SSDP_MX = 1
-    SSDP_ST = "urn:schemas-upnp-org:device:Basic:1"
-
-    ssdpRequest = "M-SEARCH * HTTP/1.1\r\n" + \
-                  "HOST: %s:%d\r\n" % (SSDP_ADDR, SSDP_PORT) + \
-                  "MAN: \"ssdp:discover\"\r\n" + \
-                  "MX: %d\r\n" % (SSDP_MX,) + \
-                  "ST: %s\r\n" % (SSDP_ST,) + "\r\n"
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(5.0)
-    sock.sendto(ssdpRequest.encode(), (SSDP_ADDR, SSDP_PORT))
-    print("running discover bridge")
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    sock.setblocking(False)
+    start = monotonic()
+    deadline = start + SSDP_TIMEOUT
+    resend_at = start + SSDP_RESEND_DELAY
     try:
-        result = sock.recv(4096).decode()
-        lines = result.splitlines()
-        for i in range(len(lines)):
-            if lines[i].startswith('hue-bridgeid'):
-                location_index = i - 2
-                sock.close()
-                return lines[location_index].split('/')[2]
-    except:
+        # UDP is lossy, so the search is sent a second time shortly after
+        sock.sendto(SSDP_REQUEST, (SSDP_ADDR, SSDP_PORT))
+        while True:
+            now = monotonic()
+            if now >= deadline:
+                break
+            if resend_at is not None and now >= resend_at:
+                sock.sendto(SSDP_REQUEST, (SSDP_ADDR, SSDP_PORT))
+                resend_at = None
+            wait_until = deadline if resend_at is None else resend_at
+            readable, _, _ = select.select([sock], [], [], wait_until - now)
+            if not readable:
+                continue
+            match = SSDP_BRIDGE_RE.search(sock.recv(4096))
+            if match:
+                return match.group(1).decode()
+    except socket.error:
         pass
+    finally:
+        sock.close()
     raise DeviceNotFoundException()
 
 